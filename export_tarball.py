@@ -13,16 +13,25 @@ Example usage:
 
 export_tarball.py /foo/bar
 
-The above will create file /foo/bar.tar.xz.
+The above will create file /foo/bar.tar.xz, or /foo/bar.tar.zst when
+--format=zst is given.
 """
 
+import collections
+import fcntl
+import io
+import multiprocessing
 import optparse
 import os
+import queue
 import re
+import shutil
 import stat
 import subprocess
 import sys
 import tarfile
+import tempfile
+import threading
 
 
 nonessential_dirs = (
@@ -108,26 +117,224 @@ TEST_DIRS = (
     'tools/perf/testdata',
 )
 
+# Files matching this are kept even inside nonessential directories.
+KEEP_RE = re.compile(r'\.(gn|gni|grd|grdp|isolate|pydeps)(\.\S+)?$')
+KEEP_EXTS = frozenset(('gn', 'gni', 'grd', 'grdp', 'isolate', 'pydeps'))
+
+# Every directory whose contents are dropped by --remove-nonessential-files.
+EXCLUDED_DIRS = frozenset(nonessential_dirs + TEST_DIRS)
+
+# Directories with an excluded directory somewhere below them. '.' stands for
+# the root of the source tree.
+EXCLUDED_PARENTS = frozenset(['.'] + [
+    path[:i] for path in EXCLUDED_DIRS for i, c in enumerate(path) if c == '/'])
+
+
+# Size of the blocks xz compresses independently, one per thread.
+XZ_BLOCK_SIZE = 16 << 20
+
+# Size of the chunks handed from the archive writer to the compressor.
+PIPE_CHUNK_SIZE = 1 << 20
+
+
+# Number of regular files opened and read ahead of the one being archived.
+READAHEAD_FILES = 64
+
+# Files at least this large are copied into the pipe with os.sendfile(); the
+# contents of smaller ones are read into the archive buffer, which takes fewer
+# system calls than sending them one by one.
+SENDFILE_MIN_SIZE = 64 * 1024
+
+# Directories that --jobs splits into one unit per child, on top of the
+# roots, because they hold most of the tree.
+SPLIT_DIRS = ('third_party',)
+
+# Number of batches per worker process with --jobs, so that the workers that
+# finish early can pick up more work.
+BATCHES_PER_JOB = 4
+
+
+class PipeWriter:
+  """Writes to a pipe from a background thread.
+
+  Chunks are passed to the thread through a bounded queue, so that walking the
+  tree and building the archive overlap with the compressor consuming the
+  previous chunks instead of waiting for every write to the pipe. Files can be
+  queued as well; the kernel then copies them into the pipe with
+  os.sendfile(), without passing their contents through Python.
+  """
+
+  def __init__(self, pipe, depth=XZ_BLOCK_SIZE // PIPE_CHUNK_SIZE):
+    self.__pipe = pipe
+    # A larger pipe lets each sendfile() call move more data at once.
+    if hasattr(fcntl, 'F_SETPIPE_SZ'):
+      try:
+        fcntl.fcntl(pipe.fileno(), fcntl.F_SETPIPE_SZ, PIPE_CHUNK_SIZE)
+      except OSError:
+        pass
+    self.__queue = queue.Queue(maxsize=depth)
+    self.__error = None
+    self.__closed = False
+    self.__thread = threading.Thread(target=self.__drain, daemon=True)
+    self.__thread.start()
+
+  def write(self, data):
+    """Queues data, which must not be modified afterwards."""
+    self.__put((data, None, 0))
+
+  def write_file(self, f, size):
+    """Queues the first size bytes of the file f, and closes f once written."""
+    self.__put((None, f, size))
+
+  def close(self):
+    if self.__closed:
+      return
+    self.__closed = True
+    self.__queue.put(None)
+    self.__thread.join()
+    if self.__error is not None:
+      raise self.__error
+
+  def __put(self, item):
+    if self.__error is not None:
+      raise self.__error
+    self.__queue.put(item)
+
+  def __drain(self):
+    while True:
+      item = self.__queue.get()
+      if item is None:
+        return
+      data, f, size = item
+      # Keep consuming after an error so that the writer never blocks on a
+      # full queue; the error is raised from its next write() or close().
+      try:
+        if self.__error is None:
+          if f is None:
+            self.__pipe.write(data)
+          else:
+            self.__send_file(f, size)
+      except OSError as e:
+        self.__error = e
+      finally:
+        if f is not None:
+          f.close()
+
+  def __send_file(self, f, size):
+    self.__pipe.flush()
+    offset = 0
+    while offset < size:
+      sent = os.sendfile(self.__pipe.fileno(), f.fileno(), offset,
+                         size - offset)
+      if not sent:
+        raise OSError('%s: file shrank while being archived' % f.name)
+      offset += sent
+
+
+# Header fields following the link name, which are the same for every entry
+# since the archive always records root as the owner.
+_USTAR_OWNER = (tarfile.POSIX_MAGIC + b'0'.ljust(32, tarfile.NUL) * 2 +
+                tarfile.NUL * 16)
+
+
+def ustar_header(name, mode, typeflag, size, mtime, linkname=''):
+  """Returns the 512-byte ustar header of an entry owned by root.
+
+  Returns None if the entry cannot be described by a plain ustar header, i.e.
+  if a name is not ASCII or too long, or the file is too large.
+  """
+  try:
+    name = name.encode('ascii')
+    linkname = linkname.encode('ascii')
+  except UnicodeEncodeError:
+    return None
+
+  prefix = b''
+  if len(name) > 100:
+    # Split long names at a slash into the prefix and name fields.
+    i = name.find(b'/', len(name) - 101, len(name) - 1)
+    if i < 0 or i > 155:
+      return None
+    prefix, name = name[:i], name[i + 1:]
+
+  if len(linkname) > 100 or size >= 8**11:
+    return None
+
+  header = b''.join((
+      name.ljust(100, tarfile.NUL),
+      b'%07o\0' % (mode & 0o7777),
+      b'0000000\0',  # uid
+      b'0000000\0',  # gid
+      b'%011o\0' % size,
+      b'%011o\0' % mtime,
+      b'        ',  # checksum
+      typeflag,
+      linkname.ljust(100, tarfile.NUL),
+      _USTAR_OWNER,
+      prefix.ljust(155, tarfile.NUL),
+      tarfile.NUL * 12,
+  ))
+  return header[:148] + b'%06o\0' % sum(header) + header[155:]
+
+
+class MyTarFile:
+  """Writes a tar stream of the source tree to a file object.
+
+  Headers are built directly instead of going through tarfile.TarInfo, since
+  owner and mtime are the same for every entry. tarfile is only used for the
+  rare entries that need a PAX extended header.
+  """
+
+  def __init__(self, fileobj):
+    self.__fileobj = fileobj
+    self.__buffer = bytearray()
+    self.__offset = 0
+    self.__inodes = {}
+    self.__remove_nonessential_files = False
+    self.__verbose = False
+    self.__src_dir = '.'
+    self.__mtime = 0
 
-# Workaround lack of the exclude parameter in add method in python-2.4.
-# TODO(phajdan.jr): remove the workaround when it's not needed on the bot.
-class MyTarFile(tarfile.TarFile):
   def set_remove_nonessential_files(self, remove):
-    # pylint: disable=attribute-defined-outside-init
     self.__remove_nonessential_files = remove
 
   def set_verbose(self, verbose):
-    # pylint: disable=attribute-defined-outside-init
     self.__verbose = verbose
 
   def set_src_dir(self, src_dir):
-    # pylint: disable=attribute-defined-outside-init
     self.__src_dir = src_dir
 
   def set_mtime(self, mtime):
-    # pylint: disable=attribute-defined-outside-init
     self.__mtime = mtime
 
+  def set_hard_links(self, inodes):
+    """Sets the arcname under which each (st_ino, st_dev) with several links
+    is stored first, so that an archive holding only part of the tree stores
+    the other names as hard links even if the first one is in another part.
+    """
+    self.__inodes = dict(inodes)
+
+  def set_offset(self, offset):
+    """Sets the position in the tar stream the archive starts at, so that
+    close() pads an archive continuing another one to a full record.
+    """
+    self.__offset = offset
+
+  def tell(self):
+    """Returns the position in the tar stream, including buffered data."""
+    return self.__offset
+
+  @staticmethod
+  def __in_excluded_dir(rel_name):
+    # Walk up the parents instead of prefix-matching against every excluded
+    # directory; this is O(depth) per entry rather than O(len(EXCLUDED_DIRS)).
+    path = rel_name
+    while path:
+      if path in EXCLUDED_DIRS:
+        return True
+      path = path.rpartition('/')[0]
+    return False
+
   def __report_skipped(self, name):
     if self.__verbose:
       print('D\t%s' % name)
@@ -136,24 +343,99 @@ class MyTarFile(tarfile.TarFile):
     if self.__verbose:
       print('A\t%s' % name)
 
-  def __filter(self, tar_info):
-    tar_info.mtime = self.__mtime
-    tar_info.mode |= stat.S_IWUSR
-    tar_info.uid = 0
-    tar_info.gid = 0
-    tar_info.uname = '0'
-    tar_info.gname = '0'
-    return tar_info
-
-  # pylint: disable=redefined-builtin
-  def add(self, name, arcname=None, recursive=True, *, filter=None):
-    rel_name = os.path.relpath(name, self.__src_dir)
-    file_path, file_name = os.path.split(name)
+  def __write(self, data):
+    self.__buffer += data
+    self.__offset += len(data)
+    if len(self.__buffer) >= PIPE_CHUNK_SIZE:
+      self.flush()
+
+  def __header(self, name, arcname, st):
+    """Returns the header block(s) for name and the size of its contents.
+
+    Returns (None, 0) for file types that cannot be archived.
+    """
+    arcname = arcname.replace(os.sep, '/').lstrip('/')
+    mode = st.st_mode
+    size = 0
+    linkname = ''
+    if stat.S_ISREG(mode):
+      inode = (st.st_ino, st.st_dev)
+      if (st.st_nlink > 1 and
+          self.__inodes.setdefault(inode, arcname) != arcname):
+        typeflag = tarfile.LNKTYPE
+        linkname = self.__inodes[inode]
+      else:
+        typeflag = tarfile.REGTYPE
+        size = st.st_size
+    elif stat.S_ISDIR(mode):
+      typeflag = tarfile.DIRTYPE
+      arcname += '/'
+    elif stat.S_ISLNK(mode):
+      typeflag = tarfile.SYMTYPE
+      linkname = os.readlink(name)
+    elif stat.S_ISFIFO(mode):
+      typeflag = tarfile.FIFOTYPE
+    elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+      typeflag = tarfile.CHRTYPE if stat.S_ISCHR(mode) else tarfile.BLKTYPE
+    else:
+      return None, 0
+
+    mode = stat.S_IMODE(mode) | stat.S_IWUSR
+    header = None
+    if typeflag not in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+      header = ustar_header(arcname, mode, typeflag, size, self.__mtime,
+                            linkname)
+    if header is None:
+      tar_info = tarfile.TarInfo(arcname)
+      tar_info.type = typeflag
+      tar_info.mode = mode
+      tar_info.size = size
+      tar_info.mtime = self.__mtime
+      tar_info.linkname = linkname
+      tar_info.uname = '0'
+      tar_info.gname = '0'
+      if typeflag in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+        tar_info.devmajor = os.major(st.st_rdev)
+        tar_info.devminor = os.minor(st.st_rdev)
+      header = tar_info.tobuf(tarfile.PAX_FORMAT, tarfile.ENCODING,
+                              'surrogateescape')
+    return header, size
+
+  def __walk(self, name, arcname, rel_name, entry, recursive, excluded,
+             may_exclude):
+    """Yields (name, arcname, lstat result) for name and, if it is a
+    directory, everything below it that should go into the archive.
+
+    rel_name is name relative to the source directory. It is built from the
+    parent's rather than with os.path.relpath() for every entry.
+
+    entry is the os.DirEntry for name, or None at the root of the walk. The
+    file type checks are answered from the directory listing, and an entry is
+    only stat()ed once it is known to go into the archive.
+
+    Skipped directories are pruned together with their whole subtree, and
+    whether an entry lies in an excluded directory is inherited from its
+    parent instead of being recomputed from scratch for every file. Below a
+    directory which is neither excluded nor in EXCLUDED_PARENTS (e.g.
+    chrome/browser) no entry can be excluded, so may_exclude turns the
+    lookups off for the whole subtree.
+    """
+    if entry is None:
+      file_name = os.path.basename(name)
+      st = os.lstat(name)
+      is_link = stat.S_ISLNK(st.st_mode)
+      is_dir = stat.S_ISDIR(st.st_mode)
+      is_file = stat.S_ISREG(st.st_mode)
+    else:
+      file_name = entry.name
+      st = None
+      is_link = entry.is_symlink()
+      is_dir = entry.is_dir(follow_symlinks=False)
+      is_file = entry.is_file(follow_symlinks=False)
 
-    if os.path.islink(name) and not os.path.exists(name):
-      # Beware of symlinks whose target is nonessential
-      self.__report_skipped(name)
-      return
+    if may_exclude and not excluded:
+      excluded = rel_name in EXCLUDED_DIRS
+      may_exclude = rel_name in EXCLUDED_PARENTS
 
     if file_name == '__pycache__' or file_name.endswith('.pyc'):
       self.__report_skipped(name)
@@ -163,13 +445,12 @@ class MyTarFile(tarfile.TarFile):
       # Since m132 devtools-frontend requires files in node_modules/<module>/out
       # to prevent this happening again we can exclude based on the path
       # rather than explicitly allowlisting
-      if 'node_modules' not in file_path:
+      if 'node_modules' not in os.path.dirname(name):
         self.__report_skipped(name)
         return
 
     if file_name == '.git':
-      if not any(
-          rel_name.startswith(essential) for essential in ESSENTIAL_GIT_DIRS):
+      if not rel_name.startswith(ESSENTIAL_GIT_DIRS):
         self.__report_skipped(name)
         return
 
@@ -180,27 +461,376 @@ class MyTarFile(tarfile.TarFile):
         self.__report_skipped(name)
         return
 
-      # Preserve GN files, and other potentially critical files, so that
-      # `gn gen` can work.
-      #
-      # Preserve `*.pydeps` files too. `gn gen` reads them to generate build
-      # targets, even if those targets themselves are not built
-      # (crbug.com/1362021).
-      keep_file = (
-          re.search(r'\.(gn|gni|grd|grdp|isolate|pydeps)(\.\S+)?$', file_name)
-          or rel_name in ESSENTIAL_FILES)
-
-      # Remove contents of non-essential directories.
-      if not keep_file:
-        if any((rel_name == path or rel_name.startswith(path + '/'))
-            for path in (set(nonessential_dirs) | set(TEST_DIRS))) and \
-            (os.path.isfile(name) or os.path.islink(name)):
+      # Remove contents of non-essential directories. The directories
+      # themselves are kept, since they may still contain files to keep.
+      if excluded and (is_file or is_link):
+        # Preserve GN files, and other potentially critical files, so that
+        # `gn gen` can work.
+        #
+        # Preserve `*.pydeps` files too. `gn gen` reads them to generate build
+        # targets, even if those targets themselves are not built
+        # (crbug.com/1362021).
+        #
+        # KEEP_RE can only match if one of KEEP_EXTS is a whole dot-separated
+        # component of the name after the first dot, and always matches if it
+        # is the last one. The regular expression is only needed when it is
+        # some other component, which is rare.
+        parts = file_name.split('.')
+        if len(parts) > 1 and parts[-1] in KEEP_EXTS:
+          keep_file = True
+        elif KEEP_EXTS.isdisjoint(parts[1:-1]):
+          keep_file = False
+        else:
+          keep_file = KEEP_RE.search(file_name)
+        if not keep_file and rel_name not in ESSENTIAL_FILES:
           self.__report_skipped(name)
           return
 
-    self.__report_added(name)
-    tarfile.TarFile.add(
-        self, name, arcname=arcname, recursive=recursive, filter=self.__filter)
+    # Beware of symlinks whose target is nonessential. This is checked last,
+    # since it is the only check which needs to stat() the link target, and
+    # only done for symlinks; everything else is already known from lstat().
+    if is_link and not os.path.exists(name):
+      self.__report_skipped(name)
+      return
+
+    if st is None:
+      st = entry.stat(follow_symlinks=False)
+    yield name, arcname, st
+
+    if recursive and is_dir:
+      with os.scandir(name) as it:
+        children = sorted(it, key=lambda child: child.name)
+      rel_dir = '' if rel_name == '.' else rel_name + '/'
+      for child in children:
+        yield from self.__walk(child.path, os.path.join(arcname, child.name),
+                               rel_dir + child.name, child, recursive,
+                               excluded, may_exclude)
+
+  def walk(self, name, arcname, recursive=True):
+    """Yields (name, arcname, lstat result) for every entry to archive from
+    the tree at name."""
+    rel_name = os.path.relpath(name, self.__src_dir)
+    excluded = self.__in_excluded_dir(rel_name)
+    return self.__walk(name, arcname, rel_name, None, recursive, excluded,
+                       True)
+
+  def add(self, name, arcname=None, recursive=True):
+    if arcname is None:
+      arcname = name
+    # Regular files are opened a few entries ahead of the one being written,
+    # and the kernel is asked to start reading them in the background, so that
+    # a cold page cache does not stall the archive on every small file.
+    pending = collections.deque()
+    try:
+      for path, path_arcname, st in self.walk(name, arcname, recursive):
+        header, size = self.__header(path, path_arcname, st)
+        if header is None:
+          self.__report_skipped(path)
+          continue
+
+        self.__report_added(path)
+        f = None
+        if size:
+          f = open(path, 'rb')
+          if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        pending.append((path, header, f, size))
+        if len(pending) > READAHEAD_FILES:
+          self.__add_file(*pending.popleft())
+
+      while pending:
+        self.__add_file(*pending.popleft())
+    finally:
+      for _, _, f, _ in pending:
+        if f is not None:
+          f.close()
+
+  def close(self):
+    """Writes the end-of-archive marker, padded to a full record."""
+    self.__write(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+    remainder = self.__offset % tarfile.RECORDSIZE
+    if remainder:
+      self.__write(tarfile.NUL * (tarfile.RECORDSIZE - remainder))
+    self.flush()
+
+  def flush(self):
+    """Writes out the buffered part of the archive."""
+    if self.__buffer:
+      self.__fileobj.write(self.__buffer)
+      self.__buffer = bytearray()
+
+  def __add_file(self, name, header, f, size):
+    self.__write(header)
+    if f is None:
+      return
+
+    if size >= SENDFILE_MIN_SIZE:
+      # Hand the file to the writer thread, which sendfile()s it into the
+      # pipe right after the data buffered so far.
+      self.flush()
+      self.__fileobj.write_file(f, size)
+      self.__offset += size
+    else:
+      with f:
+        data = f.read(size)
+      if len(data) != size:
+        raise OSError('%s: file shrank while being archived' % name)
+      self.__write(data)
+
+    remainder = size % tarfile.BLOCKSIZE
+    if remainder:
+      self.__write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+
+
+def get_compressor_command(output_format, progress, threads=0, pixz=False):
+  """Returns the command line compressing stdin to stdout in output_format,
+  which is 'xz' or 'zst'.
+
+  threads is the number of compression threads, 0 meaning one per core. pixz
+  selects pixz instead of xz for 'xz'.
+  """
+  if output_format == 'zst':
+    # zstd is several times faster than xz at a similar ratio on source code,
+    # and decompresses much faster. --long=27 still decompresses with zstd's
+    # default memory limit.
+    return (['zstd', '-T%d' % threads, '-19', '--long=27'] +
+            (['--progress'] if progress else []) + ['-c', '-'])
+
+  # pixz writes a standard .xz file with a block index, so that pixz and xz
+  # can both decompress it in parallel. -t keeps it from appending its own
+  # index of the tar members, so the file still decompresses to the plain tar
+  # stream. It is opt-in, since unlike xz it does not reduce its threads to
+  # stay within a memory limit, and -9 takes about 670 MiB per thread.
+  if pixz:
+    return ['pixz', '-t', '-9']
+
+  # An explicit block size makes xz split the stream into independent blocks,
+  # so that all threads are kept busy and the result can also be decompressed
+  # in parallel.
+  return (['xz', '-T%d' % threads, '-9', '--block-size=%d' % XZ_BLOCK_SIZE] +
+          (['-v'] if progress else []) + ['-'])
+
+
+def create_archive(fileobj, options, mtime):
+  """Returns a MyTarFile writing to fileobj, configured from options."""
+  archive = MyTarFile(fileobj)
+  archive.set_remove_nonessential_files(options.remove_nonessential_files)
+  archive.set_verbose(options.verbose)
+  archive.set_src_dir(options.src_dir)
+  archive.set_mtime(mtime)
+  return archive
+
+
+def get_roots(src_dir, prefix, test_data):
+  """Returns (path, arcname) of the trees to archive, named below prefix."""
+  if not test_data:
+    return [(src_dir, prefix)]
+
+  roots = []
+  for directory in TEST_DIRS:
+    test_dir = os.path.join(src_dir, directory)
+    if not os.path.isdir(test_dir):
+      # A directory may not exist depending on the milestone we're building
+      # a tarball for.
+      print('"%s" not present; skipping.' % test_dir)
+      continue
+    roots.append((test_dir, os.path.join(prefix, directory)))
+  return roots
+
+
+def run_gnu_tar(archive, roots, src_dir, basename, mtime, out, verbose):
+  """Archives the entries selected by archive with GNU tar, writing to out.
+
+  GNU tar is given the list of entries from MyTarFile.walk() rather than
+  exclude patterns, since files to keep (e.g. GN files) may live inside
+  excluded directories. roots must be named below '.', which is replaced by
+  basename in the archive. Returns the exit status of tar.
+  """
+  replacement = basename.replace('\\', '\\\\').replace('&', '\\&')
+  replacement = replacement.replace(',', '\\,')
+  tar = subprocess.Popen(
+      ['tar', '--create', '--file=-', '--directory=' + src_dir,
+       '--no-recursion', '--null', '--files-from=-', '--format=gnu',
+       '--record-size=%d' % PIPE_CHUNK_SIZE,
+       '--owner=0:0', '--group=0:0', '--mtime=@%d' % mtime, '--mode=u+w',
+       '--transform=s,^\\.,%s,S' % replacement] +
+      (['--verbose'] if verbose else []),
+      stdin=subprocess.PIPE,
+      stdout=out)
+
+  with tar.stdin:
+    for path, arcname in roots:
+      for _, entry_arcname, _ in archive.walk(path, arcname):
+        tar.stdin.write(os.fsencode(entry_arcname) + b'\0')
+
+  return tar.wait()
+
+
+def split_roots(src_dir, roots):
+  """Splits each directory in roots into the directory entry itself and one
+  unit per child, so that the units can be archived independently.
+  Directories in SPLIT_DIRS are split the same way instead of becoming a
+  single unit.
+
+  Returns a list of (path, arcname, recursive).
+  """
+  units = []
+
+  def split(path, arcname):
+    units.append((path, arcname, False))
+    for child in sorted(os.listdir(path)):
+      child_path = os.path.join(path, child)
+      child_arcname = os.path.join(arcname, child)
+      if (os.path.relpath(child_path, src_dir) in SPLIT_DIRS and
+          os.path.isdir(child_path) and not os.path.islink(child_path)):
+        split(child_path, child_arcname)
+      else:
+        units.append((child_path, child_arcname, True))
+
+  for path, arcname in roots:
+    if os.path.isdir(path) and not os.path.islink(path):
+      split(path, arcname)
+    else:
+      units.append((path, arcname, False))
+  return units
+
+
+def batch_units(units, sizes, count):
+  """Splits units into about count batches of consecutive units with about the
+  same total size.
+
+  Returns a list of (units, size), in the order of units.
+  """
+  target = sum(sizes) / count
+  batches = []
+  batch, batch_size = [], 0
+  for unit, size in zip(units, sizes):
+    batch.append(unit)
+    batch_size += size
+    if batch_size >= target:
+      batches.append((batch, batch_size))
+      batch, batch_size = [], 0
+  if batch or not batches:
+    batches.append((batch, batch_size))
+  return batches
+
+
+def scan_unit(options, mtime, unit):
+  """Walks unit without printing anything.
+
+  Returns the estimated size of its part of the archive, and (inode, arcname)
+  for each regular file in it with several links.
+  """
+  path, arcname, recursive = unit
+  scanner = create_archive(None, options, mtime)
+  scanner.set_verbose(False)
+  size = 0
+  links = []
+  for _, entry_arcname, st in scanner.walk(path, arcname, recursive):
+    size += tarfile.BLOCKSIZE
+    if stat.S_ISREG(st.st_mode):
+      size += st.st_size
+      if st.st_nlink > 1:
+        links.append(((st.st_ino, st.st_dev),
+                      entry_arcname.replace(os.sep, '/').lstrip('/')))
+  return size, links
+
+
+def write_fragment(options, mtime, units, inodes, fragment):
+  """Archives units into the file named fragment as a separate compressed
+  stream.
+
+  The fragment does not end the tar archive, so that the concatenated
+  fragments form a single archive. inodes is passed to
+  MyTarFile.set_hard_links(), so that hard links are stored as in a single
+  archive. Returns the exit status of the compressor and the size of the
+  uncompressed fragment.
+  """
+  with open(fragment, 'wb') as out:
+    compressor = subprocess.Popen(
+        get_compressor_command(options.format, False, threads=1),
+        stdin=subprocess.PIPE,
+        stdout=out)
+  pipe = PipeWriter(compressor.stdin)
+  archive = create_archive(pipe, options, mtime)
+  archive.set_hard_links(inodes)
+  try:
+    for path, arcname, recursive in units:
+      archive.add(path, arcname=arcname, recursive=recursive)
+    archive.flush()
+  finally:
+    pipe.close()
+    compressor.stdin.close()
+  return compressor.wait(), archive.tell()
+
+
+def write_parallel(options, mtime, roots, tarball):
+  """Writes the archive of roots to tarball using options.jobs worker
+  processes.
+
+  The tree is split into batches of about the same size, each batch is
+  archived and compressed on its own by a worker, and the resulting streams
+  are concatenated in tree order, followed by a last stream holding the
+  end-of-archive marker padded to a full record. Both xz and zstd decompress
+  concatenated streams as one, so tar reads the result as a single archive.
+
+  Before the batches are formed, the workers scan the units to estimate their
+  sizes and find the files with several links. The tree is therefore walked
+  twice, but both walks are spread over the workers, and the second one
+  mostly finds the directory entries and inodes in the kernel's caches.
+  Returns True on success.
+  """
+  units = split_roots(options.src_dir, roots)
+  output_dir = os.path.dirname(os.path.abspath(tarball.name))
+  fragments = []
+  try:
+    with multiprocessing.Pool(options.jobs) as pool:
+      scans = pool.starmap(scan_unit,
+                           [(options, mtime, unit) for unit in units])
+
+      # Store each file with several links in full under the name that comes
+      # first in the archive, and as a hard link under the others, which may
+      # be in other fragments.
+      inodes = {}
+      for _, unit_links in scans:
+        for inode, arcname in unit_links:
+          inodes.setdefault(inode, arcname)
+
+      batches = batch_units(units, [size for size, _ in scans],
+                            options.jobs * BATCHES_PER_JOB)
+      for _ in batches:
+        fd, fragment = tempfile.mkstemp(dir=output_dir)
+        os.close(fd)
+        fragments.append(fragment)
+
+      # Start the largest batches first, so that none of them is left to run
+      # alone at the end.
+      results = {}
+      for i in sorted(range(len(batches)), key=lambda i: -batches[i][1]):
+        results[i] = pool.apply_async(
+            write_fragment,
+            (options, mtime, batches[i][0], inodes, fragments[i]))
+      results = [results[i].get() for i in range(len(batches))]
+      if any(status != 0 for status, _ in results):
+        return False
+
+    for fragment in fragments:
+      with open(fragment, 'rb') as f:
+        shutil.copyfileobj(f, tarball)
+  finally:
+    for fragment in fragments:
+      os.unlink(fragment)
+
+  trailer = io.BytesIO()
+  archive = MyTarFile(trailer)
+  archive.set_offset(sum(size for _, size in results))
+  archive.close()
+  tarball.flush()
+  compressor = subprocess.run(
+      get_compressor_command(options.format, False, threads=1),
+      input=trailer.getvalue(),
+      stdout=tarball)
+  return compressor.returncode == 0
 
 
 def main(argv):
@@ -212,8 +842,14 @@ def main(argv):
   parser.add_option("--test-data", action="store_true")
   # TODO(phajdan.jr): Remove --xz option when it's not needed for compatibility.
   parser.add_option("--xz", action="store_true")
+  parser.add_option("--format", type="choice", choices=["xz", "zst"],
+                    default="xz")
   parser.add_option("--verbose", action="store_true", default=False)
   parser.add_option("--progress", action="store_true", default=False)
+  parser.add_option("--pixz", action="store_true", default=False)
+  parser.add_option("--gnu-tar", dest="gnu_tar",
+                    action="store_true", default=False)
+  parser.add_option("--jobs", type="int", default=1)
   parser.add_option("--src-dir")
   parser.add_option("--version")
 
@@ -221,7 +857,7 @@ def main(argv):
 
   if len(args) != 1:
     print('You must provide only one argument: output file name')
-    print('(without .tar.xz extension).')
+    print('(without .tar.xz or .tar.zst extension).')
     return 1
 
   if not options.version:
@@ -232,46 +868,84 @@ def main(argv):
     print('Cannot find the src directory ' + options.src_dir)
     return 1
 
-  output_fullname = args[0] + '.tar.xz'
-  output_basename = options.basename or os.path.basename(args[0])
+  if options.jobs < 1:
+    print('--jobs must be at least 1.')
+    return 1
 
-  tarball = open(output_fullname, 'w')
-  xz = subprocess.Popen(
-      ['xz', '-T', '0', '-9'] + (['-v'] if options.progress else []) + ['-'],
-      stdin=subprocess.PIPE,
-      stdout=tarball)
+  if options.jobs > 1 and options.gnu_tar:
+    print('--jobs cannot be combined with --gnu-tar.')
+    return 1
 
-  archive = MyTarFile.open(None, 'w|', xz.stdin)
-  archive.set_remove_nonessential_files(options.remove_nonessential_files)
-  archive.set_verbose(options.verbose)
-  archive.set_src_dir(options.src_dir)
+  if options.jobs > 1 and options.progress:
+    print('--jobs cannot be combined with --progress.')
+    return 1
+
+  if options.pixz and options.format != 'xz':
+    print('--pixz can only be used with --format=xz.')
+    return 1
+
+  if options.pixz and (options.progress or options.jobs > 1):
+    print('--pixz cannot be combined with --progress or --jobs.')
+    return 1
+
+  output_fullname = args[0] + '.tar.' + options.format
+  output_basename = options.basename or os.path.basename(args[0])
 
   with open(
       os.path.join(options.src_dir, 'build/util/LASTCHANGE.committime'),
       'r') as f:
     timestamp = int(f.read())
-    archive.set_mtime(timestamp)
 
-  try:
-    if options.test_data:
-      for directory in TEST_DIRS:
-        test_dir = os.path.join(options.src_dir, directory)
-        if not os.path.isdir(test_dir):
-          # A directory may not exist depending on the milestone we're building
-          # a tarball for.
-          print('"%s" not present; skipping.' % test_dir)
-          continue
-        archive.add(test_dir,
-                    arcname=os.path.join(output_basename, directory))
-    else:
-      archive.add(options.src_dir, arcname=output_basename)
-  finally:
-    archive.close()
+  tarball = open(output_fullname, 'wb')
+
+  if options.jobs > 1:
+    roots = get_roots(options.src_dir, output_basename, options.test_data)
+    if not write_parallel(options, timestamp, roots, tarball):
+      print('%s failed!' %
+            get_compressor_command(options.format, False, threads=1)[0])
+      return 1
 
-  xz.stdin.close()
+    tarball.close()
+    return 0
 
-  if xz.wait() != 0:
-    print('xz -9 failed!')
+  compressor_command = get_compressor_command(
+      options.format, options.progress, pixz=options.pixz)
+  compressor = subprocess.Popen(
+      compressor_command,
+      stdin=subprocess.PIPE,
+      stdout=tarball)
+
+  if options.gnu_tar:
+    # GNU tar writes the archive; MyTarFile only selects the entries.
+    pipe = None
+  else:
+    pipe = PipeWriter(compressor.stdin)
+  archive = create_archive(pipe, options, timestamp)
+
+  tar_status = 0
+  if options.gnu_tar:
+    tar_status = run_gnu_tar(
+        archive, get_roots(options.src_dir, '.', options.test_data),
+        options.src_dir, output_basename, timestamp, compressor.stdin,
+        options.verbose)
+  else:
+    try:
+      for path, arcname in get_roots(options.src_dir, output_basename,
+                                     options.test_data):
+        archive.add(path, arcname=arcname)
+    finally:
+      archive.close()
+
+    pipe.close()
+
+  compressor.stdin.close()
+
+  if tar_status != 0:
+    print('tar failed!')
+    return 1
+
+  if compressor.wait() != 0:
+    print('%s failed!' % compressor_command[0])
     return 1
 
   tarball.flush()
@@ -279,6 +953,5 @@ def main(argv):
 
   return 0
 
-
 if __name__ == "__main__":
   sys.exit(main(sys.argv[1:]))